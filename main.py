@@ -1,18 +1,22 @@
-from fastapi import Body
 from fastapi.middleware.cors import CORSMiddleware
-from datetime import date as dt_date
+from fastapi.middleware.gzip import GZipMiddleware
+import asyncio
+import csv
 import hashlib
 import hmac
+import io
+import itertools
 import os
-from datetime import datetime, timezone
+import time
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta, timezone
 from datetime import date
-from fastapi.responses import JSONResponse
+from fastapi.responses import ORJSONResponse
 from typing import Optional
 
 import asyncpg
-from fastapi import FastAPI, HTTPException, Request, Header
-from pydantic import BaseModel, Field, validator
-from fastapi.responses import JSONResponse
+import orjson
+from fastapi import FastAPI, HTTPException, Request, Header, Response
 
 import logging
 
@@ -30,22 +34,68 @@ def parse_iso_timestamp(value: str) -> datetime:
     return dt.astimezone(timezone.utc)
 
 
-class WebhookEvent(BaseModel):
-    event_type: str = Field(..., pattern="^(join|leave)$")
-    session_id: str
-    user_id: str
-    timestamp: datetime
-
-    @validator("timestamp", pre=True)
-    def validate_timestamp(cls, v: str) -> datetime:  # type: ignore[override]
+# Zoom timestamps arrive as ISO strings or epoch milliseconds. The defaults
+# bind the hot lookups once instead of resolving them on every webhook.
+def _to_dt(v, _now=datetime.now, _utc=timezone.utc, _fromts=datetime.fromtimestamp) -> datetime:
+    if v is None:
+        return _now(_utc)
+    if isinstance(v, (int, float)):
+        # Zoom event_ts is usually milliseconds
+        return _fromts(v / 1000, tz=_utc)
+    if isinstance(v, str):
         return parse_iso_timestamp(v)
+    return _now(_utc)
 
 
 DATABASE_URL = os.environ.get("DATABASE_URL")
 if not DATABASE_URL:
     raise RuntimeError("DATABASE_URL environment variable is required")
 
-app = FastAPI(title="Zoom Attendance MVP")
+# Pool tuning. Every uvicorn worker opens its own pool plus one dedicated
+# webhook-writer connection, so Postgres sees up to
+# WEB_CONCURRENCY * (DB_POOL_MAX + 1) connections.
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "2"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "10"))
+DB_STMT_CACHE = int(os.getenv("DB_STMT_CACHE", "1024"))
+
+# Shared by the pool and the writer connection.
+DB_CONNECT_KWARGS = dict(
+    statement_cache_size=DB_STMT_CACHE,
+    # Don't let one slow query hold a connection indefinitely.
+    command_timeout=10,
+    # Sent in the startup packet, so no extra round trip per connection.
+    server_settings={"jit": "off", "application_name": "zoom-attendance"},
+)
+
+# Webhook writes are coalesced: the writer waits this long after a wake-up
+# for a burst to accumulate, then applies up to this many events per claim.
+# It also polls the inbox at WEBHOOK_POLL_INTERVAL to pick up rows accepted
+# by other workers or left over from a restart.
+WEBHOOK_BATCH_SIZE = int(os.getenv("WEBHOOK_BATCH_SIZE", "500"))
+WEBHOOK_BATCH_WAIT = float(os.getenv("WEBHOOK_BATCH_WAIT", "0.02"))
+WEBHOOK_POLL_INTERVAL = float(os.getenv("WEBHOOK_POLL_INTERVAL", "1.0"))
+# Inbox rows whose batch has failed to flush this many times (e.g. it keeps
+# timing out) are parked in webhook_dead_letter instead of retried forever.
+# Age alone never expires a row, so a long outage or deploy gap loses nothing.
+WEBHOOK_MAX_ATTEMPTS = int(os.getenv("WEBHOOK_MAX_ATTEMPTS", "10"))
+
+# pg_try_advisory_xact_lock key: only one worker process applies inbox rows
+# at a time, so events land in arrival order across processes.
+INBOX_LOCK_ID = 7_311_001
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Pool (min_size connections opened eagerly) and batch writer are ready
+    # before the first request is accepted.
+    await startup()
+    try:
+        yield
+    finally:
+        await shutdown()
+
+
+app = FastAPI(title="Zoom Attendance MVP", default_response_class=ORJSONResponse, lifespan=lifespan)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],  # later you can lock this down
@@ -53,6 +103,9 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+# Compresses the streamed CSV chunk-by-chunk (and larger JSON payloads)
+# only for clients that send Accept-Encoding: gzip.
+app.add_middleware(GZipMiddleware, minimum_size=1024, compresslevel=6)
 
 API_KEY = os.getenv("API_KEY")
 
@@ -64,51 +117,345 @@ def require_api_key(x_api_key: str | None):
         raise HTTPException(status_code=401, detail="Unauthorized")
 
 
+_ZOOM_SECRET = os.getenv("ZOOM_WEBHOOK_SECRET")
+# Signed requests older (or newer) than this many seconds are treated as replays.
+ZOOM_SIGNATURE_TOLERANCE = int(os.getenv("ZOOM_SIGNATURE_TOLERANCE", "300"))
+_ZOOM_SECRET_BYTES: bytes | None = _ZOOM_SECRET.encode() if _ZOOM_SECRET else None
+# Keyed once; copy() clones the padded inner/outer SHA-256 state so each
+# signature skips key setup.
+_ZOOM_HMAC = hmac.new(_ZOOM_SECRET_BYTES, digestmod=hashlib.sha256) if _ZOOM_SECRET_BYTES else None
+
+
+def zoom_hmac_hex(message: bytes) -> str:
+    h = _ZOOM_HMAC.copy()
+    h.update(message)
+    return h.hexdigest()
+
+
+def verify_zoom_signature(raw: bytes, signature: str | None, timestamp: str | None) -> None:
+    # Same dev escape hatch as require_api_key: no secret, no check.
+    if not _ZOOM_SECRET_BYTES:
+        return
+    if not signature or not timestamp:
+        raise HTTPException(status_code=401, detail="Missing Zoom signature")
+    try:
+        sent_at = int(timestamp)
+    except ValueError:
+        raise HTTPException(status_code=401, detail="Invalid Zoom signature timestamp")
+    if abs(time.time() - sent_at) > ZOOM_SIGNATURE_TOLERANCE:
+        raise HTTPException(status_code=401, detail="Stale Zoom signature timestamp")
+    message = b"v0:" + timestamp.encode() + b":" + raw
+    expected = b"v0=" + zoom_hmac_hex(message).encode()
+    if not hmac.compare_digest(expected, signature.encode()):
+        raise HTTPException(status_code=401, detail="Invalid Zoom signature")
+
+
 pool: Optional[asyncpg.Pool] = None
 
 
-@app.on_event("startup")
+# Set by the webhook handler so the writer doesn't wait for the next poll.
+inbox_ready: Optional[asyncio.Event] = None
+writer_task: Optional[asyncio.Task] = None
+# Owned by webhook_writer only; see writer_connection().
+writer_conn: Optional[asyncpg.Connection] = None
+
+
 async def startup() -> None:
-    global pool
-    pool = await asyncpg.create_pool(DATABASE_URL, min_size=1, max_size=10)
+    global pool, inbox_ready, writer_task
+    pool = await asyncpg.create_pool(
+        DATABASE_URL,
+        min_size=DB_POOL_MIN,
+        max_size=DB_POOL_MAX,
+        max_inactive_connection_lifetime=300,
+        max_queries=50000,
+        **DB_CONNECT_KWARGS,
+    )
+
+    # Start set so rows left over from a previous run are applied right away.
+    inbox_ready = asyncio.Event()
+    inbox_ready.set()
+    writer_task = asyncio.create_task(webhook_writer())
 
 
-@app.on_event("shutdown")
 async def shutdown() -> None:
-    global pool
+    global pool, writer_task, writer_conn
+    if writer_task:
+        writer_task.cancel()
+        try:
+            await writer_task
+        except asyncio.CancelledError:
+            pass
+        writer_task = None
+    if pool:
+        try:
+            await flush_inbox()
+        except Exception:
+            logger.exception("Final webhook flush failed; events remain in webhook_inbox")
+    if writer_conn:
+        await writer_conn.close()
+        writer_conn = None
     if pool:
         await pool.close()
         pool = None
 
 
-async def ensure_entities(conn: asyncpg.Connection, session_id: str, user_id: str) -> None:
-    await conn.execute("INSERT INTO sessions(session_id) VALUES($1) ON CONFLICT DO NOTHING", session_id)
-    await conn.execute("INSERT INTO users(id) VALUES($1) ON CONFLICT DO NOTHING", user_id)
+INBOX_SQL = """
+    INSERT INTO webhook_inbox (event_type, session_id, user_id, participant_key, email, event_time)
+    VALUES ($1, $2, $3, $4, $5, $6)
+    ON CONFLICT (event_type, session_id, participant_key, event_time) DO NOTHING
+    RETURNING id
+"""
+
+# A run of join events is COPYed into this temp table, then applied with a
+# single set-based statement. It exists only on the writer's own connection,
+# created once when that connection opens, so pooled request connections
+# never carry it.
+JOIN_STAGE_SQL = """
+    CREATE TEMP TABLE IF NOT EXISTS join_stage (
+        inbox_id BIGINT NOT NULL,
+        session_id TEXT NOT NULL,
+        user_id TEXT NOT NULL,
+        participant_key TEXT NOT NULL,
+        email TEXT NULL,
+        join_time TIMESTAMPTZ NOT NULL
+    ) ON COMMIT DELETE ROWS
+"""
+JOIN_STAGE_COLS = ("inbox_id", "session_id", "user_id", "participant_key", "email", "join_time")
+
+# Drain join_stage, upsert sessions/users, open the segments in arrival order
+# and register the ones actually inserted in open_segments, all in one statement. The FK checks run
+# at end of statement, after the CTE inserts.
+JOIN_SQL = """
+    WITH j AS (
+        DELETE FROM join_stage RETURNING *
+    ), s AS (
+        INSERT INTO sessions (session_id) SELECT DISTINCT session_id FROM j ON CONFLICT DO NOTHING
+    ), u AS (
+        INSERT INTO users (id) SELECT DISTINCT user_id FROM j ON CONFLICT DO NOTHING
+    ), seg AS (
+        INSERT INTO attendance_segments (session_id, user_id, participant_key, email, join_time)
+        SELECT session_id, user_id, participant_key, email, join_time FROM j ORDER BY inbox_id
+        -- A redelivered join that was already applied opens nothing new.
+        ON CONFLICT (session_id, participant_key, join_time) DO NOTHING
+        RETURNING id, session_id, user_id, participant_key, email, join_time
+    )
+    INSERT INTO open_segments (segment_id, session_id, user_id, participant_key, email, join_time)
+    SELECT id, session_id, user_id, participant_key, email, join_time FROM seg
+"""
+
+# Close open segments for a whole run of leave events at once. Matching runs
+# against the small open_segments table; attendance_segments is then only
+# touched by primary key.
+# Match in order: participant_key, then email, then user_id fallback.
+# A leave only touches segments opened by a join, so the session and user
+# rows already exist. Leaves stamped before the join are skipped rather than
+# tripping leave_after_join and failing the whole batch.
+LEAVE_SQL = """
+    WITH closed AS (
+        DELETE FROM open_segments o
+        USING unnest($1::text[], $2::text[], $3::text[], $4::text[], $5::timestamptz[])
+            AS l(session_id, user_id, participant_key, email, ts)
+        WHERE o.session_id = l.session_id
+          AND l.ts >= o.join_time
+          AND (
+                o.participant_key = l.participant_key
+             OR (l.email IS NOT NULL AND o.email = l.email)
+             OR o.user_id = l.user_id
+          )
+        RETURNING o.segment_id, o.join_time, l.ts
+    )
+    UPDATE attendance_segments a
+    SET
+        leave_time = c.ts,
+        duration_sec = GREATEST(0, EXTRACT(EPOCH FROM (c.ts - c.join_time))::int)
+    FROM closed c
+    WHERE a.id = c.segment_id
+"""
+
+# Claim the oldest pending events. SKIP LOCKED keeps a concurrent claim from
+# blocking on rows another transaction already holds.
+CLAIM_SQL = """
+    DELETE FROM webhook_inbox
+    WHERE id IN (
+        SELECT id FROM webhook_inbox
+        ORDER BY id
+        LIMIT $1
+        FOR UPDATE SKIP LOCKED
+    )
+    RETURNING id, event_type, session_id, user_id, participant_key, email, event_time
+"""
+
+DEAD_LETTER_SQL = """
+    INSERT INTO webhook_dead_letter
+        (id, event_type, session_id, user_id, participant_key, email, event_time, error)
+    VALUES ($1, $2, $3, $4, $5, $6, $7, $8)
+"""
+
+FAILED_ATTEMPT_SQL = """
+    UPDATE webhook_inbox
+    SET attempts = attempts + 1, last_error = $2
+    WHERE id = ANY($1::bigint[])
+"""
+
+EXPIRE_SQL = """
+    WITH d AS (
+        DELETE FROM webhook_inbox
+        WHERE id IN (
+            SELECT id FROM webhook_inbox
+            WHERE attempts >= $1
+            FOR UPDATE SKIP LOCKED
+        )
+        RETURNING id, event_type, session_id, user_id, participant_key, email, event_time,
+                  attempts, last_error
+    )
+    INSERT INTO webhook_dead_letter
+        (id, event_type, session_id, user_id, participant_key, email, event_time, error)
+    SELECT id, event_type, session_id, user_id, participant_key, email, event_time,
+           'gave up after ' || attempts || ' attempts: ' || COALESCE(last_error, '')
+    FROM d
+"""
+
+SESSIONS_SQL = """
+    SELECT session_id
+    FROM sessions
+    ORDER BY session_id DESC
+    LIMIT $1
+"""
+
+async def apply_events(conn: asyncpg.Connection, batch: list) -> None:
+    # Apply consecutive runs of the same event type in arrival order, so
+    # a leave followed by a rejoin never closes the new segment.
+    for event_type, run in itertools.groupby(batch, key=lambda e: e[1]):
+        run = list(run)
+        if event_type == "join":
+            await conn.copy_records_to_table(
+                "join_stage", records=[(e[0], *e[2:]) for e in run], columns=JOIN_STAGE_COLS
+            )
+            await conn.execute(JOIN_SQL)
+        else:
+            _, _, sessions, users, keys, emails, times = zip(*run)
+            await conn.execute(LEAVE_SQL, sessions, users, keys, emails, times)
+
+
+async def writer_connection() -> asyncpg.Connection:
+    # The writer keeps one connection outside the pool, so pool recycling
+    # never drops join_stage and no join run pays for re-creating it.
+    global writer_conn
+    if writer_conn is None or writer_conn.is_closed():
+        writer_conn = await asyncpg.connect(DATABASE_URL, **DB_CONNECT_KWARGS)
+        await writer_conn.execute(JOIN_STAGE_SQL)
+    return writer_conn
+
+
+async def flush_inbox() -> int:
+    """Apply one batch of inbox rows; returns how many were claimed."""
+    conn = await writer_connection()
+    claimed_ids: list[int] = []
+    try:
+        async with conn.transaction():
+            if not await conn.fetchval("SELECT pg_try_advisory_xact_lock($1)", INBOX_LOCK_ID):
+                return 0  # another worker is flushing and will pick these up
+            rows = await conn.fetch(CLAIM_SQL, WEBHOOK_BATCH_SIZE)
+            # DELETE ... RETURNING has no defined order; restore arrival order.
+            batch = sorted(tuple(r) for r in rows)
+            claimed_ids = [e[0] for e in batch]
+
+            # Each attempt runs under a savepoint, so one bad event can't roll
+            # back the claim and wedge the head of the inbox.
+            try:
+                async with conn.transaction():
+                    await apply_events(conn, batch)
+            except asyncpg.PostgresError:
+                logger.exception(f"Batch of {len(batch)} webhook events failed; retrying one by one")
+                for e in batch:
+                    try:
+                        async with conn.transaction():
+                            await apply_events(conn, [e])
+                    except asyncpg.PostgresError as exc:
+                        logger.warning(f"Dead-lettering webhook inbox row {e[0]}: {exc}")
+                        await conn.execute(DEAD_LETTER_SQL, *e, str(exc))
+            return len(batch)
+    except Exception as exc:
+        # The claim rolled back with the batch; charge those rows an attempt.
+        if claimed_ids:
+            await record_failed_attempt(claimed_ids, exc)
+        raise
+
+
+async def record_failed_attempt(ids: list[int], exc: Exception) -> None:
+    try:
+        conn = await writer_connection()
+        async with conn.transaction():
+            await conn.execute(FAILED_ATTEMPT_SQL, ids, f"{type(exc).__name__}: {exc}")
+            result = await conn.execute(EXPIRE_SQL, WEBHOOK_MAX_ATTEMPTS)
+    except Exception:
+        # E.g. the database is unreachable; that shouldn't burn attempts anyway.
+        logger.exception("Could not record failed webhook flush attempt")
+        return
+    moved = int(result.rsplit(" ", 1)[-1])
+    if moved:
+        logger.warning(f"Dead-lettered {moved} webhook inbox rows after {WEBHOOK_MAX_ATTEMPTS} failed attempts")
+
+
+async def webhook_writer() -> None:
+    while True:
+        try:
+            await asyncio.wait_for(inbox_ready.wait(), WEBHOOK_POLL_INTERVAL)
+            await asyncio.sleep(WEBHOOK_BATCH_WAIT)
+        except asyncio.TimeoutError:
+            pass
+        inbox_ready.clear()
+        try:
+            # Keep claiming while full batches come back, i.e. drain a backlog.
+            while await flush_inbox() >= WEBHOOK_BATCH_SIZE:
+                pass
+        except Exception:
+            # Rows stay in webhook_inbox and are retried on the next round,
+            # until they run out of attempts (see record_failed_attempt).
+            logger.exception("Failed to flush webhook inbox")
+
+
+_HANDLED_EVENTS = frozenset({
+    "endpoint.url_validation",
+    "meeting.participant_joined",
+    "meeting.participant_left",
+})
 
 
 @app.post("/webhooks/zoom")
-async def zoom_webhook(body: dict = Body(...)):
+async def zoom_webhook(
+    request: Request,
+    x_zm_signature: str | None = Header(default=None),
+    x_zm_request_timestamp: str | None = Header(default=None),
+):
+    raw = await request.body()
+    try:
+        body = orjson.loads(raw)
+    except orjson.JSONDecodeError:
+        raise HTTPException(status_code=400, detail="Invalid JSON body")
+    if not isinstance(body, dict):
+        raise HTTPException(status_code=400, detail="Invalid JSON body")
+
     event = body.get("event")
     logger.info(f"Received Zoom event: {event}")
 
+    # ✅ Event filter: ignored events have no side effects, so answer them
+    # before any signature or payload work.
+    if event not in _HANDLED_EVENTS:
+        return ORJSONResponse({"ok": True, "ignored": True})
+
+    # Signature covers the exact bytes Zoom sent, not the parsed body.
+    verify_zoom_signature(raw, x_zm_signature, x_zm_request_timestamp)
+
     # --- Zoom endpoint validation ---
     if event == "endpoint.url_validation":
         plain_token = body["payload"]["plainToken"]
-        secret = os.environ.get("ZOOM_WEBHOOK_SECRET")
-        if not secret:
+        if not _ZOOM_SECRET_BYTES:
             raise HTTPException(status_code=500, detail="Missing ZOOM_WEBHOOK_SECRET")
 
-        encrypted_token = hmac.new(
-            secret.encode(),
-            plain_token.encode(),
-            hashlib.sha256
-        ).hexdigest()
-
-        return {"plainToken": plain_token, "encryptedToken": encrypted_token}
+        encrypted_token = zoom_hmac_hex(plain_token.encode())
 
-    # ✅ Event filter: ignore everything except join/leave
-    if event not in ("meeting.participant_joined", "meeting.participant_left"):
-        return {"ok": True, "ignored": True}
+        return ORJSONResponse({"plainToken": plain_token, "encryptedToken": encrypted_token})
 
     # ---- Parse Zoom payload into our normalized fields ----
     # ---- Parse Zoom payload into our normalized fields ----
@@ -123,7 +470,7 @@ async def zoom_webhook(body: dict = Body(...)):
 
     # IMPORTANT: Zoom identifiers are inconsistent across join/leave.
     # We store a "participant_key" and also store email if available.
-    participant_key = (
+    participant_key = str(
         participant.get("participant_uuid")       # correct key
         or participant.get("participant_id")
         or participant.get("id")
@@ -135,128 +482,87 @@ async def zoom_webhook(body: dict = Body(...)):
     # We keep user_id for your summaries (email if available; otherwise participant_key)
     user_id = email_norm or str(participant_key)
 
-    # timestamp parsing helper (Zoom sometimes gives ms int)
-    def to_dt(v) -> datetime:
-        if v is None:
-            return datetime.now(timezone.utc)
-        if isinstance(v, (int, float)):
-            # Zoom event_ts is usually milliseconds
-            return datetime.fromtimestamp(v / 1000, tz=timezone.utc)
-        if isinstance(v, str):
-            return parse_iso_timestamp(v)
-        return datetime.now(timezone.utc)
-
     if event == "meeting.participant_joined":
-        ts = to_dt(participant.get("join_time") or body.get("event_ts"))
+        ts = _to_dt(participant.get("join_time") or body.get("event_ts"))
         event_type = "join"
     else:
-        ts = to_dt(participant.get("leave_time") or body.get("event_ts"))
+        ts = _to_dt(participant.get("leave_time") or body.get("event_ts"))
         event_type = "leave"
 
-    if pool is None:
+    if pool is None or inbox_ready is None:
         raise HTTPException(status_code=500, detail="Database not ready")
 
+    # Durably accept the event with a single INSERT, then let the batch
+    # writer apply it. Answer 200 rather than 202: Zoom only counts 200/204
+    # as delivered and would otherwise retry.
     async with pool.acquire() as conn:
-        async with conn.transaction():
-            await ensure_entities(conn, session_id, user_id)
-
-            if event_type == "join":
-                await conn.execute(
-                    """
-                    INSERT INTO attendance_segments (session_id, user_id, participant_key, email, join_time)
-                    VALUES ($1, $2, $3, $4, $5)
-                    """,
-                    session_id, user_id, participant_key, email_norm, ts
-                )
-                return {
-                    "ok": True,
-                    "action": "segment_opened",
-                    "session_id": session_id,
-                    "user_id": user_id,
-                    "participant_key": participant_key,
-                    "email": email_norm,
-                }
-
-            # CLOSE the most recent open segment for this session.
-            # Match in order: participant_key, then email, then user_id fallback.
-            result = await conn.execute(
-                """
-                UPDATE attendance_segments
-                SET
-                    leave_time = $1,
-                    duration_sec = GREATEST(0, EXTRACT(EPOCH FROM ($1 - join_time))::int)
-                WHERE session_id = $2
-                  AND leave_time IS NULL
-                  AND (
-                        participant_key = $3
-                     OR ($4 IS NOT NULL AND email = $4)
-                     OR user_id = $5
-                  )
-                """,
-                ts, session_id, participant_key, email_norm, user_id
-            )
+        inbox_id = await conn.fetchval(
+            INBOX_SQL, event_type, session_id, user_id, participant_key, email_norm, ts
+        )
+    if inbox_id is not None:
+        inbox_ready.set()
+
+    return ORJSONResponse(
+        content={
+            "ok": True,
+            "queued": True,
+            "duplicate": inbox_id is None,
+            "event_type": event_type,
+            "session_id": session_id,
+            "user_id": user_id,
+            "participant_key": participant_key,
+            "email": email_norm,
+        },
+    )
 
-            return {
-                "ok": True,
-                "action": "segments_closed",
-                "db_result": result,
-                "session_id": session_id,
-                "user_id": user_id,
-                "participant_key": participant_key,
-                "email": email_norm,
-            }
 
 
 
 
 
+# Short-lived cache for polled dashboard endpoints:
+# (path, params) -> (expires_at, etag, body)
+RESPONSE_CACHE_MAX = 256
+_response_cache: dict[tuple, tuple[float, str, bytes]] = {}
 
-@app.get("/sessions")
-async def list_sessions():
-    """
-    Returns one row per Zoom session with total attendance stats
-    """
-    if pool is None:
-        raise HTTPException(status_code=500, detail="Database not ready")
 
-    async with pool.acquire() as conn:
-        rows = await conn.fetch(
-            """
-            SELECT
-                session_id,
-                participant_count,
-                total_participant_seconds,
-                first_join,
-                last_seen
-            FROM session_summary
-            ORDER BY first_join DESC
-            """
-        )
-
-    return [dict(r) for r in rows]
+async def cached_json(key: tuple, ttl: float, if_none_match: str | None, load) -> Response:
+    now = time.monotonic()
+    hit = _response_cache.get(key)
+    if hit is None or hit[0] <= now:
+        body = orjson.dumps(await load())
+        etag = f'"{hashlib.blake2b(body, digest_size=16).hexdigest()}"'
+        if key not in _response_cache and len(_response_cache) >= RESPONSE_CACHE_MAX:
+            _response_cache.pop(next(iter(_response_cache)))  # drop the oldest entry
+        hit = _response_cache[key] = (now + ttl, etag, body)
 
+    _, etag, body = hit
+    if if_none_match and (if_none_match.strip() == "*" or etag in (t.strip() for t in if_none_match.split(","))):
+        return Response(status_code=304, headers={"ETag": etag})
+    return Response(content=body, media_type="application/json", headers={"ETag": etag})
 
 
 @app.get("/sessions")
-async def list_sessions(limit: int = 20):
+async def list_sessions(limit: int = 20, if_none_match: str | None = Header(default=None)):
     if pool is None:
         raise HTTPException(status_code=500, detail="DB not ready")
 
-    async with pool.acquire() as conn:
-        rows = await conn.fetch(
-            """
-            SELECT session_id
-            FROM sessions
-            ORDER BY session_id DESC
-            LIMIT $1
-            """,
-            limit
-        )
+    async def load():
+        async with pool.acquire() as conn:
+            rows = await conn.fetch(SESSIONS_SQL, limit)
+        return [{"session_id": r[0]} for r in rows]
 
-    return JSONResponse(content=[{"session_id": r["session_id"]} for r in rows])
+    return await cached_json(("/sessions", limit), 30, if_none_match, load)
 
 
 
+# Column order of every per-user summary query below. Zipping values against
+# this tuple skips the per-row Record.keys() lookup that dict(r) does.
+SUMMARY_COLS = ("user_id", "segments", "total_seconds", "first_join", "last_seen")
+
+CSV_CHUNK_SIZE = 64 * 1024
+
+
 @app.get("/sessions/{session_id}")
 async def session_details(session_id: str):
     """
@@ -281,40 +587,67 @@ async def session_details(session_id: str):
             session_id
         )
 
-    return {
+    return ORJSONResponse({
         "session_id": session_id,
-        "participants": [dict(r) for r in rows]
-    }
+        "participants": [dict(zip(SUMMARY_COLS, r, strict=True)) for r in rows]
+    })
 
-from fastapi.responses import PlainTextResponse
+from fastapi.responses import StreamingResponse
 
-@app.get("/sessions/{session_id}/csv", response_class=PlainTextResponse)
+@app.get("/sessions/{session_id}/csv")
 async def session_details_csv(session_id: str):
     if pool is None:
         raise HTTPException(status_code=500, detail="Database not ready")
 
-    async with pool.acquire() as conn:
-        rows = await conn.fetch(
-            """
-            SELECT
-                user_id,
-                segments,
-                total_seconds,
-                first_join,
-                last_seen
-            FROM session_user_summary
-            WHERE session_id = $1
-            ORDER BY total_seconds DESC
-            """,
-            session_id
-        )
-
-    lines = ["user_id,segments,total_seconds,first_join,last_seen"]
-    for r in rows:
-        lines.append(
-            f"{r['user_id']},{r['segments']},{r['total_seconds']},{r['first_join']},{r['last_seen']}"
-        )
-    return "\n".join(lines)
+    async def gen():
+        # csv.writer (C-implemented) handles quoting; it writes straight
+        # through to a reused bytes buffer that is flushed in ~64 KiB chunks,
+        # so at most one chunk of rows is ever held in memory.
+        buf = io.BytesIO()
+        text = io.TextIOWrapper(buf, encoding="utf-8", newline="", write_through=True)
+        writer = csv.writer(text, lineterminator="\n")
+
+        writer.writerow(SUMMARY_COLS)
+        yield buf.getvalue()
+        buf.seek(0)
+        buf.truncate(0)
+
+        async with pool.acquire() as conn, conn.transaction():
+            async for user_id, segments, total_seconds, first_join, last_seen in conn.cursor(
+                """
+                SELECT
+                    user_id,
+                    segments,
+                    total_seconds,
+                    first_join,
+                    last_seen
+                FROM session_user_summary
+                WHERE session_id = $1
+                ORDER BY total_seconds DESC
+                """,
+                session_id,
+                prefetch=1000,
+            ):
+                writer.writerow((
+                    user_id,
+                    segments,
+                    total_seconds,
+                    first_join.isoformat() if first_join else None,
+                    last_seen.isoformat() if last_seen else None,
+                ))
+                if buf.tell() >= CSV_CHUNK_SIZE:
+                    yield buf.getvalue()
+                    buf.seek(0)
+                    buf.truncate(0)
+
+        if buf.tell():
+            yield buf.getvalue()
+
+    return StreamingResponse(
+        gen(),
+        media_type="text/csv",
+        headers={"Content-Disposition": f'attachment; filename="{session_id}.csv"'},
+    )
 
 @app.get("/health")
 async def health():
@@ -323,7 +656,11 @@ async def health():
     return {"status": "ok"}
 
 @app.get("/daily/{day}/summary")
-async def daily_summary(day: str, x_api_key: str | None = Header(default=None)):
+async def daily_summary(
+    day: str,
+    x_api_key: str | None = Header(default=None),
+    if_none_match: str | None = Header(default=None),
+):
     require_api_key(x_api_key)
     """
     day format: YYYY-MM-DD
@@ -339,40 +676,35 @@ async def daily_summary(day: str, x_api_key: str | None = Header(default=None)):
         raise HTTPException(status_code=400, detail="Invalid date. Use YYYY-MM-DD")
 
     start = datetime(d.year, d.month, d.day, 0, 0, 0, tzinfo=timezone.utc)
-    end = start.replace(hour=23, minute=59, second=59)
+    end = start + timedelta(days=1)  # half-open [start, end) window
 
-    async with pool.acquire() as conn:
-        rows = await conn.fetch(
-            """
-            SELECT
-                user_id,
-                COUNT(*) AS segments,
-                SUM(duration_sec) AS total_seconds,
-                MIN(join_time) AS first_join,
-                MAX(COALESCE(leave_time, NOW())) AS last_seen
-            FROM attendance_segments
-            WHERE join_time >= $1 AND join_time <= $2
-              AND leave_time IS NOT NULL
-            GROUP BY user_id
-            ORDER BY total_seconds DESC
-            """,
-            start,
-            end
-        )
-        if not rows:
-            return []
+    async def load():
+        async with pool.acquire() as conn:
+            rows = await conn.fetch(
+                """
+                SELECT
+                    user_id,
+                    COUNT(*)::int AS segments,
+                    COALESCE(SUM(duration_sec), 0)::bigint AS total_seconds,
+                    MIN(join_time) AS first_join,
+                    MAX(COALESCE(leave_time, NOW())) AS last_seen
+                FROM attendance_segments
+                WHERE join_time >= $1 AND join_time < $2
+                  AND leave_time IS NOT NULL
+                GROUP BY user_id
+                ORDER BY total_seconds DESC
+                """,
+                start,
+                end
+            )
 
-    data = []
-    for r in rows:
-        data.append({
-            "user_id": r["user_id"],
-            "segments": int(r["segments"] or 0),
-            "total_seconds": int(r["total_seconds"] or 0),
-            "first_join": r["first_join"].isoformat() if r["first_join"] else None,
-            "last_seen": r["last_seen"].isoformat() if r["last_seen"] else None,
-        })
+        # Casts and NULL handling happen in SQL; orjson handles the datetimes.
+        return [dict(zip(SUMMARY_COLS, r, strict=True)) for r in rows]
 
-    return JSONResponse(content=data)
+    # Past days only change when a late leave closes a segment; today's
+    # summary is still filling in.
+    ttl = 3600 if d < datetime.now(timezone.utc).date() else 30
+    return await cached_json(("/daily/summary", d), ttl, if_none_match, load)
 
 
 
@@ -400,17 +732,5 @@ async def session_summary(session_id: str, x_api_key: str | None = Header(defaul
             session_id,
         )
 
-    # convert asyncpg Records into normal JSON-safe dicts
-    data = []
-    for r in rows:
-        data.append(
-            {
-                "user_id": r["user_id"],
-                "segments": r["segments"],
-                "total_seconds": r["total_seconds"],
-                "first_join": r["first_join"].isoformat() if r["first_join"] else None,
-                "last_seen": r["last_seen"].isoformat() if r["last_seen"] else None,
-            }
-        )
-
-    return JSONResponse(content=data)
+    # orjson serializes the datetime columns natively
+    return ORJSONResponse([dict(zip(SUMMARY_COLS, r, strict=True)) for r in rows])
@@ -16,6 +16,92 @@ CREATE TABLE IF NOT EXISTS attendance_segments (
     CONSTRAINT leave_after_join CHECK (leave_time IS NULL OR leave_time >= join_time)
 );
 
+-- Zoom identifiers written by the webhook handler.
+ALTER TABLE attendance_segments ADD COLUMN IF NOT EXISTS participant_key TEXT NULL;
+ALTER TABLE attendance_segments ADD COLUMN IF NOT EXISTS email TEXT NULL;
+
 CREATE INDEX IF NOT EXISTS idx_attendance_session_user ON attendance_segments (session_id, user_id);
-CREATE INDEX IF NOT EXISTS idx_attendance_open_segments ON attendance_segments (leave_time) WHERE leave_time IS NULL;
 
+-- Open-segment lookups now go through open_segments (below), so the partial
+-- indexes on attendance_segments are dropped. CONCURRENTLY avoids blocking
+-- writes on a live table (psql -f runs each statement outside a transaction).
+DROP INDEX CONCURRENTLY IF EXISTS idx_attendance_open_segments;
+DROP INDEX CONCURRENTLY IF EXISTS idx_open_segments;
+
+-- Zoom redelivers a webhook until it sees a 200/204, so the same join can
+-- arrive more than once. Keep only the first copy of any join already stored
+-- twice, then let the unique index make later redeliveries a no-op.
+DELETE FROM attendance_segments a
+USING attendance_segments b
+WHERE a.session_id = b.session_id
+  AND a.participant_key = b.participant_key
+  AND a.join_time = b.join_time
+  AND a.id > b.id;
+
+CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS uq_attendance_join
+    ON attendance_segments (session_id, participant_key, join_time);
+
+-- Range scans for /daily/{day}/summary, which only counts closed segments.
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_attendance_closed_join_time
+    ON attendance_segments (join_time) WHERE leave_time IS NOT NULL;
+
+-- Segments still waiting for a leave event. Leave matching scans only this
+-- small table, then closes the attendance_segments row by primary key.
+CREATE TABLE IF NOT EXISTS open_segments (
+    segment_id BIGINT PRIMARY KEY REFERENCES attendance_segments(id) ON DELETE CASCADE,
+    session_id TEXT NOT NULL,
+    user_id TEXT NOT NULL,
+    participant_key TEXT NULL,
+    email TEXT NULL,
+    join_time TIMESTAMPTZ NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS idx_open_segments_session ON open_segments (session_id);
+
+-- Backfill segments that were already open before open_segments existed.
+INSERT INTO open_segments (segment_id, session_id, user_id, participant_key, email, join_time)
+SELECT id, session_id, user_id, participant_key, email, join_time
+FROM attendance_segments
+WHERE leave_time IS NULL
+ON CONFLICT DO NOTHING;
+
+-- Accepted join/leave events waiting for the batch writer. Workers claim rows
+-- with FOR UPDATE SKIP LOCKED and delete them in the same transaction that
+-- applies them, so anything not yet applied survives a crash or restart.
+-- Deliberately not UNLOGGED: events have already been acknowledged to Zoom.
+CREATE TABLE IF NOT EXISTS webhook_inbox (
+    id BIGSERIAL PRIMARY KEY,
+    received_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    event_type TEXT NOT NULL,
+    session_id TEXT NOT NULL,
+    user_id TEXT NOT NULL,
+    participant_key TEXT NOT NULL,
+    email TEXT NULL,
+    event_time TIMESTAMPTZ NOT NULL,
+    attempts INT NOT NULL DEFAULT 0,
+    last_error TEXT NULL
+);
+
+-- Failed flush attempts; a row is dead-lettered after WEBHOOK_MAX_ATTEMPTS.
+ALTER TABLE webhook_inbox ADD COLUMN IF NOT EXISTS attempts INT NOT NULL DEFAULT 0;
+ALTER TABLE webhook_inbox ADD COLUMN IF NOT EXISTS last_error TEXT NULL;
+
+-- A redelivery that arrives while the original is still pending is dropped
+-- at INSERT time.
+CREATE UNIQUE INDEX IF NOT EXISTS uq_webhook_inbox_event
+    ON webhook_inbox (event_type, session_id, participant_key, event_time);
+
+-- Inbox rows that could not be applied: either the event itself made the
+-- batch statement fail, or its batch failed WEBHOOK_MAX_ATTEMPTS times.
+-- Kept for inspection and manual replay.
+CREATE TABLE IF NOT EXISTS webhook_dead_letter (
+    id BIGINT PRIMARY KEY,
+    failed_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    event_type TEXT NOT NULL,
+    session_id TEXT NOT NULL,
+    user_id TEXT NOT NULL,
+    participant_key TEXT NOT NULL,
+    email TEXT NULL,
+    event_time TIMESTAMPTZ NOT NULL,
+    error TEXT NOT NULL
+);